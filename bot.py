@@ -1,10 +1,21 @@
+import sys
 import nonebot
 from loguru import logger   # 使用loguru
+from nonebot.log import logger_id, default_filter, default_format as nonebot_format
 from nonebot.adapters.onebot.v11 import Adapter as ONEBOT_V11Adapter
 
 default_format = "{time} | {level} | {message}"
 
 nonebot.init()
+#  把 nonebot 默认的控制台输出换成 enqueue 模式，日志由后台线程写出，不在事件循环里同步写终端
+#  插件日志带有 subsystem 标记，级别已经在插件里按子系统判断过了，不再受 LOG_LEVEL 限制，这样才能用 /日志 单独调高某个子系统
+def log_filter(record):
+    if "subsystem" in record["extra"]:
+        return True
+    return default_filter(record)
+
+logger.remove(logger_id)
+logger.add(sys.stdout, level=0, diagnose=False, filter=log_filter, format=nonebot_format, enqueue=True)
 #  logger.add("trace.log", level="TRACE", format=default_format)
 #  上面注释的内容是输出Trace日志到目录下，如果想DEBUG可以取消注释
 driver = nonebot.get_driver()
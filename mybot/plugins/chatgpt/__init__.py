@@ -3,20 +3,27 @@ from nonebot import on_message, on_command
 from nonebot.adapters.onebot.v11 import Bot, Message, MessageSegment, GroupMessageEvent, PrivateMessageEvent
 from nonebot.plugin import PluginMetadata
 from nonebot.params import CommandArg
-from loguru import logger
 from datetime import datetime
 import os
 import asyncio
 import aiohttp
 import re
-import random
 import time
 from nonebot.exception import FinishedException
 from .config import config
-from .image_to_text import image_to_text, clear_image_cache
+from .log import get_logger, set_subsystem_level, subsystem_levels, subsystem_sample_rates
+from .image_to_text import image_to_text, image_placeholder, strip_image_placeholders, clear_image_cache
 from .utils import build_openai_request
 from .database import Database
 from .message_queue import MessageQueue
+from .summary import compact_history
+from .sender import SendScheduler
+from .archive import archive_old_messages, export_archive
+from .admission import AdmissionScheduler
+from .profiler import profile_event_loop
+
+logger = get_logger("chat")
+message_logger = get_logger("message")
 
 BOT_OWNER_ID = 123456  #这是bot主人的QQ号，用于权限控制，以及屏蔽相关的功能会完全不对主人进行作用
 
@@ -37,6 +44,8 @@ db = Database()
 group_queues = {}
 request_status = {}
 user_block_status = {}  # 存储用户屏蔽状态
+send_scheduler = SendScheduler(MIN_DELAY, MAX_DELAY)  # 分段回复交给调度器按会话依次发送
+admission = AdmissionScheduler(config.oachat_llm_concurrency, config.oachat_admission_weights)  # AI请求排队调度
 
 def is_user_blocked(user_id: int) -> bool:
     """
@@ -57,16 +66,29 @@ async def startup():
         is_group = "private_" not in chat_id
         await db.init_db(chat_id, is_group)
 
+    # 从共享库恢复屏蔽状态，重启或分片运行时各进程看到的是同一份屏蔽列表
+    user_block_status.update(await db.load_blocks(time.time()))
+
     asyncio.create_task(clear_image_cache())
     asyncio.create_task(clear_block_status())  # 启动时清理过期屏蔽状态任务
+    if config.oachat_summary_enable:
+        asyncio.create_task(compact_history(group_queues))  # 后台压缩较早的聊天记录为摘要
+    if config.oachat_archive_enable:
+        asyncio.create_task(archive_old_messages(db))  # 定期把过期的旧消息压缩归档
 
 
 async def clear_block_status():   #这里的定期是每次bot重启都会清理一次过期的屏蔽状态
     """
-    定期清理过期的屏蔽状态任务。
+    定期清理过期的屏蔽状态任务，分片模式下同时从共享库同步其他进程的屏蔽改动。
     """
     while True:
         current_time = time.time()
+        if config.oachat_shard_count > 1:
+            blocks = await db.load_blocks(current_time)
+            user_block_status.clear()
+            user_block_status.update(blocks)
+            await asyncio.sleep(config.oachat_shard_sync_interval)
+            continue
         for user_id in list(user_block_status.keys()):
             if current_time >= user_block_status[user_id]:
                 del user_block_status[user_id]
@@ -99,6 +121,7 @@ async def handle_message(bot: Bot, event: GroupMessageEvent | PrivateMessageEven
 
     msg = event.get_message()
     text_content = ""
+    images = []  # 延迟识图时等待识别的图片：(占位符, file id, 图片URL)
 
     async with lock:
         # 处理消息中的图片段和@段
@@ -106,12 +129,16 @@ async def handle_message(bot: Bot, event: GroupMessageEvent | PrivateMessageEven
             if seg.type == "image":
                 image_url = seg.data.get("url")
                 if image_url:
-                    text = await image_to_text(image_url)
+                    if config.oachat_image_lazy:
+                        text = image_placeholder(len(images))
+                        images.append((text, seg.data.get("file", ""), image_url))
+                    else:
+                        text = await image_to_text(image_url)
                     text_content += f"[图片: {text}]"
             elif seg.type == "at":
                 text_content += f"[at:qq={seg.data.get('qq')}]"
             elif seg.type == "text":
-                text_content += seg.data.get("text")
+                text_content += strip_image_placeholders(seg.data.get("text"))
 
         # 处理引用消息
         if event.reply:
@@ -125,10 +152,14 @@ async def handle_message(bot: Bot, event: GroupMessageEvent | PrivateMessageEven
                 if seg.type == "image":
                     image_url = seg.data.get("url")
                     if image_url:
-                        text = await image_to_text(image_url)
+                        if config.oachat_image_lazy:
+                            text = image_placeholder(len(images))
+                            images.append((text, seg.data.get("file", ""), image_url))
+                        else:
+                            text = await image_to_text(image_url)
                         text_content += f"[引用图片: {formatted_reply_time} {reply_user_info}: {text}]"
                 elif seg.type == "text":
-                    text = seg.data.get("text")
+                    text = strip_image_placeholders(seg.data.get("text"))
                     text_content += f"[引用文字: {formatted_reply_time} {reply_user_info}: {text}]"
                 elif seg.type == "at":
                     text_content += f"[at:qq={seg.data.get('qq')}]"
@@ -141,9 +172,9 @@ async def handle_message(bot: Bot, event: GroupMessageEvent | PrivateMessageEven
             "user_name": f"{event.sender.nickname}",
             "content": text_content
         }
-        await queue.add_message(new_msg, event.time)
-        logger.info(f"文字消息已加入队列：{new_msg}")
-        logger.debug(f"handle_message - 用户输入内容处理后: {text_content}")
+        await queue.add_message(new_msg, event.time, images)
+        message_logger.info("文字消息已加入队列：{}", new_msg)
+        message_logger.debug("handle_message - 用户输入内容处理后: {}", text_content)
 
 
 
@@ -168,12 +199,18 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
             return
 
     request_status[key] = True
+    admitted = False
     
     try:
         original_msg = msg.extract_plain_text().strip()
-        logger.debug(f"handle_chat - 原始用户输入内容: {original_msg}")
+        logger.debug("handle_chat - 原始用户输入内容: {}", original_msg)
 
         group_id = event.group_id if isinstance(event, GroupMessageEvent) else f"private_{event.user_id}"
+
+        # 排队等待AI请求名额，bot主人优先，超过期限没排到就放弃这次触发
+        admitted = await admission.acquire(group_id, event.user_id, priority=event.user_id == BOT_OWNER_ID)
+        if not admitted:
+            return
         if group_id not in group_queues:
             group_queues[group_id] = MessageQueue(group_id, db, is_group=isinstance(event, GroupMessageEvent))
             await group_queues[group_id].load_history()
@@ -188,8 +225,13 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
         cache = group_cache[group_id]
 
         async with lock:
-            history_messages = queue.get_messages()
+            history_window = await queue.get_history_window()
+            # 关掉延迟识图后，之前存下的占位符也要识别掉，没有占位符时什么也不做
+            await queue.resolve_images(bot, history_window)
+            history_messages = queue.get_messages(history_window)
             formatted_history = "\n".join(history_messages)
+            if queue.summary:
+                formatted_history = f"[较早记录的摘要]: {queue.summary}\n{formatted_history}"
 
             # 直接使用 event.message 的内容构建 current_input
             current_input = "".join(seg.data.get("text", "") for seg in event.message)
@@ -199,7 +241,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                 "nickname": event.sender.nickname
             }
 
-            logger.debug(f"handle_chat - 初始 current_input: {current_input}")
+            logger.debug("handle_chat - 初始 current_input: {}", current_input)
 
             # 处理消息中的图片段和@段
             for seg in event.message:
@@ -211,7 +253,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                 elif seg.type == "at":
                     current_input += f"[at:qq={seg.data.get('qq')}]"
 
-            logger.debug(f"handle_chat - 处理段落后的 current_input: {current_input}")
+            logger.debug("handle_chat - 处理段落后的 current_input: {}", current_input)
 
             # 处理引用消息
             if event.reply:
@@ -233,7 +275,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                     elif seg.type == "at":
                         current_input += f"[at:qq={seg.data.get('qq')}]"
 
-            logger.debug(f"handle_chat - 处理引用消息后的 current_input: {current_input}")
+            logger.debug("handle_chat - 处理引用消息后的 current_input: {}", current_input)
 
             context = (
                 f"以下是群里的历史记录内容\n----------\n{formatted_history}\n----------"
@@ -241,7 +283,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                 f"\n当前对话的用户名是{user_info['nickname']}，QQ号{user_info['user_id']}，一定要看清ta的名字和QQ号哦，请不要认错人哦！\n----------\n用户{user_info['nickname']}，QQ号{user_info['user_id']}发送消息：\n|{current_input}|\n"
             )
 
-            logger.debug(f"handle_chat - 构建的上下文内容: {context}")
+            logger.debug("handle_chat - 构建的上下文内容: {}", context)
 
             headers = {
                 "Content-Type": "application/json",
@@ -260,7 +302,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                             result = await response.json()
                             if response.status == 200:
                                 reply = result["choices"][0]["message"]["content"].strip()
-                                logger.debug(f"handle_chat - OpenAI回复内容: {reply}")
+                                logger.debug("handle_chat - OpenAI回复内容: {}", reply)
 
                                 # 如果回复不为空，跳出循环
                                 if reply:
@@ -302,6 +344,7 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                     current_block_end_time = user_block_status.get(user_id, 0)
                     if new_block_end_time > current_block_end_time:
                         user_block_status[user_id] = new_block_end_time
+                        await db.save_block(user_id, new_block_end_time)
                     # 替换屏蔽指令
                     reply = re.sub(rf"\[屏蔽用户{user_id}\s+{duration}{unit}\]", f"[屏蔽用户{user_id} {duration}{unit}]", reply)
 
@@ -318,19 +361,17 @@ async def handle_chat(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent,
                 "user_name": event.sender.nickname,
                 "content": reply
             }, int(datetime.now().timestamp()))
-            logger.info(f"AI回复消息已加入队列：{new_msg}")
+            logger.info("AI回复消息已加入队列：{}", new_msg)
 
             # 过滤连续分隔符和首尾分隔符
             segments = reply.split(SEPARATOR)
             segments = [seg for seg in segments if seg.strip()]
             segments = [seg.strip(SEPARATOR) for seg in segments]
 
-            for segment in segments:
-                await bot.send(event, segment)
-                # 随机延迟
-                delay = random.randint(MIN_DELAY, MAX_DELAY) / 1000.0
-                await asyncio.sleep(delay)
+            send_scheduler.submit(bot, event, group_id, segments)
     finally:
+        if admitted:
+            admission.release()
         if key != BOT_OWNER_ID:
             request_status[key] = False
     
@@ -385,6 +426,58 @@ async def handle_clear_some_memory(bot: Bot, event: GroupMessageEvent | PrivateM
     else:
         await clear_some_memory.finish("私聊不支持清除部分记忆。")
 
+# 新增导出归档记录指令
+export_memory = on_command("/导出记录", block=True, priority=5)
+
+@export_memory.handle()
+async def handle_export_memory(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent):
+    if event.user_id != BOT_OWNER_ID:
+        await export_memory.finish("你没有权限执行此操作。")
+
+    if isinstance(event, GroupMessageEvent):
+        export_path, count = await export_archive(db, str(event.group_id), True)
+        await export_memory.finish(f"已导出该群的 {count} 条归档记录到 {export_path}。")
+    else:
+        await export_memory.finish("私聊不支持导出归档记录。")
+
+# 新增查看AI请求排队状态指令
+admission_status = on_command("/调度状态", block=True, priority=5)
+
+@admission_status.handle()
+async def handle_admission_status(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent):
+    if event.user_id != BOT_OWNER_ID:
+        await admission_status.finish("你没有权限执行此操作。")
+
+    stats = admission.stats()
+    await admission_status.finish(
+        f"进行中：{stats['running']}，排队中：{stats['waiting']}，最久已等待：{stats['oldest_wait']:.1f}秒\n"
+        f"已放行：{stats['admitted']}，超时丢弃：{stats['dropped']}\n"
+        f"平均等待：{stats['avg_wait']:.2f}秒，最长等待：{stats['max_wait']:.2f}秒"
+    )
+
+# 新增性能分析指令
+profile_loop = on_command("/性能分析", block=True, priority=5)
+
+@profile_loop.handle()
+async def handle_profile_loop(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent, msg: Message = CommandArg()):
+    if event.user_id != BOT_OWNER_ID:
+        await profile_loop.finish("你没有权限执行此操作。")
+
+    args = msg.extract_plain_text().strip().split()
+    try:
+        duration = int(args[0]) if len(args) > 0 else 30
+        slow_callback_ms = int(args[1]) if len(args) > 1 else 100
+    except ValueError:
+        await profile_loop.finish("格式错误，请使用：/性能分析 [秒数] [慢回调阈值毫秒]")
+
+    if not 1 <= duration <= 300:
+        await profile_loop.finish("采样时长需要在1到300秒之间。")
+    if slow_callback_ms <= 0:
+        await profile_loop.finish("慢回调阈值需要大于0毫秒。")
+
+    await profile_loop.send(f"开始性能分析，持续{duration}秒。")
+    await profile_loop.finish(await profile_event_loop(duration, slow_callback_ms))
+
 # 新增屏蔽列表指令
 block_list = on_command("/屏蔽列表", block=True, priority=5)
 
@@ -439,6 +532,7 @@ async def handle_block_user(bot: Bot, event: GroupMessageEvent, msg: Message = C
         duration *= 3600
 
     user_block_status[user_id] = time.time() + duration
+    await db.save_block(user_id, user_block_status[user_id])
     await block_user.finish(f"已屏蔽用户 {user_id} {match.group()}。")
 
 
@@ -461,6 +555,7 @@ async def handle_unblock_user(bot: Bot, event: GroupMessageEvent, msg: Message =
 
     if user_id in user_block_status:
         del user_block_status[user_id]
+        await db.delete_block(user_id)
         await unblock_user.finish(f"已解除对用户 {user_id} 的屏蔽。")
     else:
         await unblock_user.finish(f"用户 {user_id} 未被屏蔽。")
@@ -471,5 +566,29 @@ async def handle_unblock_all_user(bot: Bot, event: GroupMessageEvent):
         await unblock_all_user.finish("你没有权限执行此操作。")
 
     user_block_status.clear()  # 清空屏蔽列表
+    await db.clear_blocks()
     await unblock_all_user.finish("已解除所有用户的屏蔽。")
 
+
+# 新增调整日志指令
+log_level = on_command("/日志", block=True, priority=5)
+
+@log_level.handle()
+async def handle_log_level(bot: Bot, event: GroupMessageEvent | PrivateMessageEvent, msg: Message = CommandArg()):
+    if event.user_id != BOT_OWNER_ID:
+        await log_level.finish("你没有权限执行此操作。")
+
+    args = msg.extract_plain_text().strip().split()
+    if not args:
+        status = [f"{name}: {level} 采样率{subsystem_sample_rates[name]}" for name, level in subsystem_levels.items()]
+        await log_level.finish("\n".join(status))
+    if len(args) not in (2, 3):
+        await log_level.finish("格式错误，请使用：/日志 子系统 级别 [采样率]")
+
+    try:
+        sample_rate = float(args[2]) if len(args) == 3 else None
+        set_subsystem_level(args[0], args[1].upper(), sample_rate)
+    except ValueError as e:
+        await log_level.finish(f"设置失败：{e}")
+
+    await log_level.finish(f"已将 {args[0]} 的日志级别设为 {args[1].upper()}。")
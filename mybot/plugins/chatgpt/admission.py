@@ -0,0 +1,112 @@
+import asyncio
+import time
+from .config import config
+from .log import get_logger
+
+logger = get_logger("chat")
+
+# 这里是AI请求的准入调度，同时进行的AI请求数由 oachat_llm_concurrency 限制，
+# 排队的请求在群之间按权重公平分配，同一个群里再在用户之间公平分配，bot主人优先，
+# 等待超过 oachat_trigger_deadline 秒的请求直接丢弃，回复得太晚就没意义了
+
+class Ticket:
+    def __init__(self, chat_id, user_id, priority: bool, deadline: float):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+class AdmissionScheduler:
+    def __init__(self, capacity: int, weights: dict):
+        self.capacity = capacity
+        self.weights = weights  # 群号/私聊id -> 权重，没有配置的默认为 1
+        self.running = 0
+        self.waiting = []
+        self.chat_usage = {}  # 每个会话已获得的加权份额
+        self.user_usage = {}  # 每个会话内每个用户已获得的份额
+        self.virtual_time = 0.0
+        self.chat_virtual_time = {}
+        self.admitted = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def weight(self, chat_id) -> float:
+        return float(self.weights.get(str(chat_id), 1))
+
+    async def acquire(self, chat_id, user_id, priority: bool = False) -> bool:
+        """
+        申请一个AI请求名额，拿到返回 True，超过期限仍未排到返回 False。拿到名额后必须调用 release。
+        """
+        ticket = Ticket(chat_id, user_id, priority, time.monotonic() + config.oachat_trigger_deadline)
+        self.enqueue(ticket)
+        self.dispatch()
+        try:
+            return await asyncio.wait_for(asyncio.shield(ticket.future), config.oachat_trigger_deadline)
+        except asyncio.TimeoutError:
+            if ticket.future.done():
+                return ticket.future.result()
+            self.waiting.remove(ticket)
+            ticket.future.cancel()
+            self.dropped += 1
+            logger.info(f"会话 {chat_id} 用户 {user_id} 的请求排队超时，已丢弃")
+            return False
+        except asyncio.CancelledError:
+            # 处理函数在排队时被取消，已经分到的名额要还回去，没分到的从队列里拿掉
+            if ticket.future.done():
+                self.release()
+            else:
+                self.waiting.remove(ticket)
+                ticket.future.cancel()
+            raise
+
+    def release(self):
+        self.running -= 1
+        self.dispatch()
+
+    def enqueue(self, ticket: Ticket):
+        # 会话或用户重新开始排队时，份额至少追平当前进度，避免空闲很久的会话一回来就长时间插队
+        user_key = (ticket.chat_id, ticket.user_id)
+        if not any(t.chat_id == ticket.chat_id for t in self.waiting):
+            self.chat_usage[ticket.chat_id] = max(self.chat_usage.get(ticket.chat_id, 0.0), self.virtual_time)
+        if not any((t.chat_id, t.user_id) == user_key for t in self.waiting):
+            self.user_usage[user_key] = max(self.user_usage.get(user_key, 0), self.chat_virtual_time.get(ticket.chat_id, 0))
+        self.waiting.append(ticket)
+
+    def dispatch(self):
+        now = time.monotonic()
+        while self.running < self.capacity:
+            candidates = [t for t in self.waiting if t.deadline > now]
+            if not candidates:
+                return
+            ticket = min(candidates, key=lambda t: (
+                not t.priority,
+                self.chat_usage[t.chat_id],
+                self.user_usage[(t.chat_id, t.user_id)],
+                t.enqueued,
+            ))
+            self.waiting.remove(ticket)
+            self.virtual_time = self.chat_usage[ticket.chat_id]
+            self.chat_virtual_time[ticket.chat_id] = self.user_usage[(ticket.chat_id, ticket.user_id)]
+            self.chat_usage[ticket.chat_id] += 1 / self.weight(ticket.chat_id)
+            self.user_usage[(ticket.chat_id, ticket.user_id)] += 1
+            self.running += 1
+            wait = now - ticket.enqueued
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            ticket.future.set_result(True)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "oldest_wait": max((now - t.enqueued for t in self.waiting), default=0.0),
+            "admitted": self.admitted,
+            "dropped": self.dropped,
+            "avg_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait,
+        }
@@ -1,14 +1,16 @@
 import aiohttp
-from loguru import logger
 from .config import config
+from .log import get_logger
 from .utils import build_openai_request
 
-async def call_openai_api(context: str):
+logger = get_logger("chat")
+
+async def call_openai_api(context: str, max_tokens: int = None):
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {config.openai_api_key}"
     }
-    data = build_openai_request(context, config.openai_max_tokens)
+    data = build_openai_request(context, max_tokens or config.openai_max_tokens)
 
     async with aiohttp.ClientSession() as session:
         try:
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import os
+import time
+from .config import config
+from .log import get_logger
+from .database import Database, GROUP_DB_DIR, PRIVATE_DB_DIR
+from .utils import owns_chat
+
+logger = get_logger("queue")
+
+EXPORT_DIR = "database/export"
+
+# 这里是旧消息的压缩归档任务，超过 oachat_archive_age_days 天的消息会被压缩成块移进归档表，
+# 消息表里只留最近的数据，get_messages 读的时候就一直是一张小表
+
+async def archive_old_messages(db: Database):
+    """
+    定期扫描所有群聊和私聊的数据库文件，归档过期的消息。分片运行时只处理当前进程负责的会话。
+    """
+    while True:
+        before = int(time.time()) - config.oachat_archive_age_days * 86400
+        for db_dir, is_group in ((GROUP_DB_DIR, True), (PRIVATE_DB_DIR, False)):
+            keep_recent = config.oachat_queue_size_group if is_group else config.oachat_queue_size_private
+            for filename in os.listdir(db_dir):
+                if not filename.endswith(".db"):
+                    continue
+                chat_id = filename[:-3]
+                if not owns_chat(chat_id):
+                    continue
+                try:
+                    archived = await db.archive_messages(
+                        chat_id, before, keep_recent, config.oachat_archive_block_size, config.oachat_archive_codec, is_group
+                    )
+                except Exception as e:
+                    logger.error(f"归档 {chat_id} 出错: {e}")
+                    continue
+                if not archived:
+                    continue
+                logger.info(f"已归档 {chat_id} 的 {archived} 条旧消息")
+                # 回收空间失败不影响已经提交的归档，单独记录
+                try:
+                    await db.reclaim_space(chat_id, is_group)
+                except Exception as e:
+                    logger.error(f"整理 {chat_id} 的数据库文件出错: {e}")
+        await asyncio.sleep(config.oachat_archive_interval)
+
+async def export_archive(db: Database, id: str, is_group: bool) -> tuple:
+    """
+    把归档的消息逐条写成 JSON Lines 文件。
+
+    :return: 导出文件路径和导出的消息条数
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    export_path = os.path.join(EXPORT_DIR, f"{id}.jsonl")
+    count = 0
+    lines = []
+    # 文件读写放到线程里做，攒够一批再写，不阻塞事件循环
+    f = await asyncio.to_thread(open, export_path, "w", encoding="utf-8")
+    try:
+        async for message in db.iter_archived_messages(id, is_group):
+            lines.append(json.dumps(message, ensure_ascii=False) + "\n")
+            count += 1
+            if len(lines) >= config.oachat_archive_block_size:
+                await asyncio.to_thread(f.writelines, lines)
+                lines = []
+        if lines:
+            await asyncio.to_thread(f.writelines, lines)
+    finally:
+        await asyncio.to_thread(f.close)
+    return export_path, count
@@ -10,6 +10,32 @@ class Config(BaseModel):
     openai_max_tokens: int
     oachat_queue_size_group: int  # 群聊消息队列条数
     oachat_queue_size_private: int  # 私聊消息队列条数
+    oachat_summary_enable: bool = False  # 是否启用后台聊天记录摘要压缩
+    oachat_summary_interval: int = 300  # 摘要压缩任务的巡检间隔，单位秒
+    oachat_summary_batch: int = 40  # 未摘要的旧消息累计到多少条才压缩一次
+    oachat_summary_keep_recent: int = 15  # 最新的多少条消息始终以原文保留，不参与压缩
+    oachat_summary_min_gap: int = 10  # 两次摘要请求之间的最小间隔，单位秒，用于限速
+    oachat_summary_max_tokens: int = 512  # 生成摘要时的最大token数
+    oachat_shard_count: int = 1  # 分片进程总数，大于1时屏蔽列表会定期从共享库同步
+    oachat_shard_index: int = 0  # 当前进程是第几个分片（从0开始），和 shard_router.py 的 --worker 顺序一致
+    oachat_shard_sync_interval: int = 5  # 分片模式下屏蔽列表的同步间隔，单位秒
+    oachat_send_rate: float = 5  # 全局每秒最多调用多少次 OneBot 发送接口
+    oachat_send_retries: int = 2  # 消息发送失败后的重试次数
+    oachat_image_lazy: bool = False  # 是否延迟识图，收到图片时只记录链接，触发对话时才批量识别
+    oachat_image_concurrency: int = 4  # 延迟识图时同时进行的识图请求数
+    oachat_log_level: str = ""  # 插件各子系统的默认日志级别，留空则跟随 LOG_LEVEL，可用 /日志 指令在运行时单独调整
+    oachat_log_sample_rate: float = 1.0  # DEBUG/INFO 日志的采样率，1.0 表示全部输出
+    oachat_log_max_length: int = 500  # 单个日志参数的最大长度，超出部分截断
+    oachat_archive_enable: bool = False  # 是否启用旧消息压缩归档
+    oachat_archive_interval: int = 3600  # 归档任务的运行间隔，单位秒
+    oachat_archive_age_days: int = 7  # 超过多少天的消息会被移入归档
+    oachat_archive_block_size: int = 500  # 每个压缩块包含的消息条数，凑不满一块的旧消息先留在原表
+    oachat_archive_codec: str = "zlib"  # 压缩方式，zlib 或 lzma
+    oachat_llm_concurrency: int = 2  # 同时进行的AI对话请求数，多出来的触发会排队
+    oachat_trigger_deadline: float = 60  # 触发排队的最长等待时间，单位秒，超时的触发直接丢弃
+    oachat_admission_weights: dict = {}  # 各会话排队时的权重，键为群号或 private_用户号，默认为 1
+    oachat_profile_sample_interval: float = 0.005  # 性能分析的调用栈采样间隔，单位秒
+    oachat_profile_top_n: int = 10  # 性能分析汇总中列出的热点函数个数
 
 config = Config.parse_obj(get_driver().config.dict())
 
@@ -1,9 +1,27 @@
 import aiosqlite
 import asyncio
+import json
+import lzma
 import os
+import zlib
 
 GROUP_DB_DIR = "database/groups"
 PRIVATE_DB_DIR = "database/private"
+SHARED_DB_PATH = "database/shared.db"  # 多个分片进程共用的数据，比如屏蔽列表
+
+# 归档用的压缩方式，压缩块里存的是一批消息字典的JSON
+ARCHIVE_CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+def compress_messages(messages: list, codec: str) -> bytes:
+    compress, _ = ARCHIVE_CODECS[codec]
+    return compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+
+def decompress_messages(data: bytes, codec: str) -> list:
+    _, decompress = ARCHIVE_CODECS[codec]
+    return json.loads(decompress(data).decode("utf-8"))
 
 # 这个类是用来处理数据库的，主要是用来存储消息的，至少现在可以使用，再改我也看不懂了
 
@@ -25,6 +43,7 @@ class Database:
     async def init_db(self, id: str, is_group: bool):
         db_path = self.get_db_path(id, is_group)
         async with aiosqlite.connect(db_path) as db:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # 只对还没有建表的新数据库生效，归档后可以增量回收空间
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -38,17 +57,30 @@ class Database:
                     message TEXT
                 )
             """)
+            await self.ensure_summary_table_exists(db)
+            await self.ensure_pending_image_table_exists(db)
             await db.commit()
 
-    async def add_message(self, id: str, message: dict, time: int, is_group: bool):
+    async def add_message(self, id: str, message: dict, time: int, is_group: bool, images: list = None):
+        """
+        images 是这条消息里等待识别的图片，每项为 (占位符, file id, 图片URL)，和消息一起写入。
+        """
         db_path = self.get_db_path(id, is_group)
         async with self.lock:
             async with aiosqlite.connect(db_path) as db:
-                await db.execute("""
+                cursor = await db.execute("""
                     INSERT INTO messages (timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """, (time, message["bot_id"], message["bot_name"], message["direction"], message["chat_id"], message["user_id"], message["user_name"], message["content"]))
+                message_id = cursor.lastrowid
+                if images:
+                    await self.ensure_pending_image_table_exists(db)
+                    await db.executemany("""
+                        INSERT INTO pending_images (message_id, placeholder, file_id, url)
+                        VALUES (?, ?, ?, ?)
+                    """, [(message_id, placeholder, file_id, url) for placeholder, file_id, url in images])
                 await db.commit()
+                return message_id  # 返回新消息的id，摘要压缩需要据此判断哪些消息已被摘要
 
     async def get_messages(self, id: str, limit: int, is_group: bool):
         db_path = self.get_db_path(id, is_group)
@@ -56,14 +88,74 @@ class Database:
             async with aiosqlite.connect(db_path) as db:
                 await self.ensure_table_exists(db)
                 cursor = await db.execute("""
-                    SELECT timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message FROM messages
+                    SELECT id, timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message AS content FROM messages
                     ORDER BY timestamp DESC
                     LIMIT ?
                 """, (limit,))
                 rows = await cursor.fetchall()
                 return [self.ensure_message_keys(dict(zip([column[0] for column in cursor.description], row))) for row in rows[::-1]]  # 按时间顺序返回消息
 
+    async def get_messages_after(self, id: str, after_id: int, limit: int, is_group: bool):
+        """
+        按时间顺序返回 after_id 之后最新的 limit 条消息。
+        """
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_table_exists(db)
+                cursor = await db.execute("""
+                    SELECT id, timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message AS content FROM messages
+                    WHERE id > ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (after_id, limit))
+                rows = await cursor.fetchall()
+                return [self.ensure_message_keys(dict(zip([column[0] for column in cursor.description], row))) for row in rows[::-1]]
+
+    async def ensure_pending_image_table_exists(self, db):
+        # 延迟识图时等待识别的图片，只由真正的图片段写入，消息内容里只有不含链接的占位符
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS pending_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id INTEGER,
+                placeholder TEXT,
+                file_id TEXT,
+                url TEXT
+            )
+        """)
+        await db.commit()
+
+    async def get_pending_images(self, id: str, message_ids: list, is_group: bool):
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_pending_image_table_exists(db)
+                cursor = await db.execute(f"""
+                    SELECT id, message_id, placeholder, file_id, url FROM pending_images
+                    WHERE message_id IN ({",".join("?" * len(message_ids))})
+                """, message_ids)
+                rows = await cursor.fetchall()
+                return [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
+
+    async def resolve_pending_images(self, id: str, contents: dict, pending_ids: list, is_group: bool):
+        """
+        写回识别后的消息内容（消息id -> 新内容），并删除已经识别完成的图片记录。
+        """
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_pending_image_table_exists(db)
+                await db.executemany("UPDATE messages SET message = ? WHERE id = ?", [(content, message_id) for message_id, content in contents.items()])
+                await db.executemany("DELETE FROM pending_images WHERE id = ?", [(pending_id,) for pending_id in pending_ids])
+                await db.commit()
+
+    async def clear_pending_images(self, db):
+        # 消息被删除或归档后，对应的待识别图片也不用再识别了
+        await self.ensure_pending_image_table_exists(db)
+        await db.execute("DELETE FROM pending_images WHERE message_id NOT IN (SELECT id FROM messages)")
+
     async def ensure_table_exists(self, db):
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,6 +171,170 @@ class Database:
         """)
         await db.commit()
 
+    async def ensure_summary_table_exists(self, db):
+        # 摘要表，每次压缩都会写入一条新的滚动摘要，last_message_id 是该摘要覆盖到的最后一条消息
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp INTEGER,
+                last_message_id INTEGER,
+                content TEXT
+            )
+        """)
+        await db.commit()
+
+    async def get_latest_summary(self, id: str, is_group: bool):
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_summary_table_exists(db)
+                cursor = await db.execute("""
+                    SELECT last_message_id, content FROM summaries
+                    ORDER BY id DESC
+                    LIMIT 1
+                """)
+                row = await cursor.fetchone()
+                if row is None:
+                    return None
+                return {"last_message_id": row[0], "content": row[1]}
+
+    async def add_summary(self, id: str, last_message_id: int, content: str, time: int, is_group: bool):
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_summary_table_exists(db)
+                await db.execute("""
+                    INSERT INTO summaries (timestamp, last_message_id, content)
+                    VALUES (?, ?, ?)
+                """, (time, last_message_id, content))
+                await db.commit()
+
+    async def get_message_id_before_latest(self, id: str, offset: int, is_group: bool) -> int:
+        """
+        返回倒数第 offset + 1 条消息的id，消息不够时返回 0。
+        """
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_table_exists(db)
+                cursor = await db.execute("SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?", (offset,))
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+
+    async def get_unsummarized_messages(self, id: str, after_id: int, keep_recent: int, limit: int, is_group: bool):
+        """
+        按时间顺序取出 after_id 之后、且不属于最新 keep_recent 条的消息，供摘要压缩使用。
+        """
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                await self.ensure_table_exists(db)
+                cursor = await db.execute("""
+                    SELECT id, timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message AS content FROM messages
+                    WHERE id > ? AND id <= (SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)
+                    ORDER BY id ASC
+                    LIMIT ?
+                """, (after_id, keep_recent, limit))
+                rows = await cursor.fetchall()
+                return [self.ensure_message_keys(dict(zip([column[0] for column in cursor.description], row))) for row in rows]
+
+    async def ensure_archive_table_exists(self, db):
+        # 归档表，每一行是一块压缩后的旧消息
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS archive (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codec TEXT,
+                first_message_id INTEGER,
+                last_message_id INTEGER,
+                first_timestamp INTEGER,
+                last_timestamp INTEGER,
+                count INTEGER,
+                data BLOB
+            )
+        """)
+        await db.commit()
+
+    async def archive_messages(self, id: str, before: int, keep_recent: int, block_size: int, codec: str, is_group: bool) -> int:
+        """
+        把早于 before 的消息按 block_size 条一块压缩进归档表并从消息表删除，最新的 keep_recent 条始终保留，返回归档的消息数。
+        """
+        db_path = self.get_db_path(id, is_group)
+        archived = 0
+        while True:
+            # 每压缩一块就释放一次锁，不让归档长时间挡住其他会话的读写
+            async with self.lock:
+                async with aiosqlite.connect(db_path) as db:
+                    await self.ensure_table_exists(db)
+                    await self.ensure_archive_table_exists(db)
+                    cursor = await db.execute("""
+                        SELECT id, timestamp, bot_id, bot_name, direction, chat_id, user_id, user_name, message AS content FROM messages
+                        WHERE timestamp < ? AND id <= (SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)
+                        ORDER BY id ASC
+                        LIMIT ?
+                    """, (before, keep_recent, block_size))
+                    rows = await cursor.fetchall()
+                    if len(rows) < block_size:
+                        break  # 凑不满一块就等下次，避免产生大量压缩率很低的小块
+                    messages = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
+                    await db.execute("""
+                        INSERT INTO archive (codec, first_message_id, last_message_id, first_timestamp, last_timestamp, count, data)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (codec, messages[0]["id"], messages[-1]["id"], messages[0]["timestamp"], messages[-1]["timestamp"], len(messages), compress_messages(messages, codec)))
+                    await db.executemany("DELETE FROM messages WHERE id = ?", [(message["id"],) for message in messages])
+                    await self.clear_pending_images(db)
+                    await db.commit()
+                    archived += len(messages)
+        return archived
+
+    async def reclaim_space(self, id: str, is_group: bool):
+        """
+        归档删除消息后回收数据库文件的空闲页。新建的数据库使用增量整理，只释放空闲页，不重写整个文件；
+        旧的数据库在空闲页超过四分之一时做一次完整整理，同时转换为增量整理模式，之后就不用再完整整理了。
+        """
+        db_path = self.get_db_path(id, is_group)
+        async with self.lock:
+            async with aiosqlite.connect(db_path) as db:
+                cursor = await db.execute("PRAGMA auto_vacuum")
+                if (await cursor.fetchone())[0] == 2:  # 2 表示 INCREMENTAL
+                    cursor = await db.execute("PRAGMA incremental_vacuum")
+                    await cursor.fetchall()
+                    await db.commit()
+                    return
+                freelist_count = (await (await db.execute("PRAGMA freelist_count")).fetchone())[0]
+                page_count = (await (await db.execute("PRAGMA page_count")).fetchone())[0]
+                if freelist_count * 4 < page_count:
+                    return
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await db.execute("VACUUM")
+
+    async def iter_archived_messages(self, id: str, is_group: bool):
+        """
+        按时间顺序逐块读取归档的消息，每次只解压一块，适合导出大量记录。
+        """
+        db_path = self.get_db_path(id, is_group)
+        last_block_id = 0
+        while True:
+            async with self.lock:
+                async with aiosqlite.connect(db_path) as db:
+                    await self.ensure_archive_table_exists(db)
+                    cursor = await db.execute("""
+                        SELECT id, codec, data FROM archive
+                        WHERE id > ?
+                        ORDER BY id ASC
+                        LIMIT 1
+                    """, (last_block_id,))
+                    row = await cursor.fetchone()
+            if row is None:
+                return
+            last_block_id = row[0]
+            for message in decompress_messages(row[2], row[1]):
+                yield message
+
+    async def clear_summaries(self, db):
+        # 删掉覆盖范围超出现存消息的摘要，清除记忆后摘要不能再引用已删除的内容
+        await self.ensure_summary_table_exists(db)
+        await db.execute("DELETE FROM summaries WHERE last_message_id > (SELECT IFNULL(MAX(id), 0) FROM messages)")
+
     def ensure_message_keys(self, message: dict) -> dict:
         keys = ["timestamp", "bot_id", "bot_name", "direction", "chat_id", "user_id", "user_name", "content"]
         for key in keys:
@@ -92,6 +348,10 @@ class Database:
             async with aiosqlite.connect(db_path) as db:
                 await self.ensure_table_exists(db)
                 await db.execute("DELETE FROM messages")
+                await self.clear_summaries(db)
+                await self.clear_pending_images(db)
+                await self.ensure_archive_table_exists(db)
+                await db.execute("DELETE FROM archive")
                 await db.commit()
 
     async def clear_private_messages(self, user_id: str):
@@ -100,6 +360,10 @@ class Database:
             async with aiosqlite.connect(db_path) as db:
                 await self.ensure_table_exists(db)
                 await db.execute("DELETE FROM messages")
+                await self.clear_summaries(db)
+                await self.clear_pending_images(db)
+                await self.ensure_archive_table_exists(db)
+                await db.execute("DELETE FROM archive")
                 await db.commit()
 
     async def delete_latest_private_messages(self, user_id: str, limit: int):
@@ -116,6 +380,8 @@ class Database:
                 message_ids = [row[0] for row in rows]
                 for message_id in message_ids:
                     await db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+                await self.clear_summaries(db)
+                await self.clear_pending_images(db)
                 await db.commit()
 
     async def delete_latest_group_messages(self, group_id: str, limit: int):
@@ -132,5 +398,49 @@ class Database:
                 message_ids = [row[0] for row in rows]
                 for message_id in message_ids:
                     await db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+                await self.clear_summaries(db)
+                await self.clear_pending_images(db)
                 await db.commit()
 
+    async def ensure_block_table_exists(self, db):
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS blocks (
+                user_id INTEGER PRIMARY KEY,
+                end_time REAL
+            )
+        """)
+        await db.commit()
+
+    async def save_block(self, user_id: int, end_time: float):
+        async with self.lock:
+            async with aiosqlite.connect(SHARED_DB_PATH) as db:
+                await self.ensure_block_table_exists(db)
+                await db.execute("INSERT OR REPLACE INTO blocks (user_id, end_time) VALUES (?, ?)", (user_id, end_time))
+                await db.commit()
+
+    async def delete_block(self, user_id: int):
+        async with self.lock:
+            async with aiosqlite.connect(SHARED_DB_PATH) as db:
+                await self.ensure_block_table_exists(db)
+                await db.execute("DELETE FROM blocks WHERE user_id = ?", (user_id,))
+                await db.commit()
+
+    async def clear_blocks(self):
+        async with self.lock:
+            async with aiosqlite.connect(SHARED_DB_PATH) as db:
+                await self.ensure_block_table_exists(db)
+                await db.execute("DELETE FROM blocks")
+                await db.commit()
+
+    async def load_blocks(self, now: float) -> dict:
+        """
+        读取共享库中仍然有效的屏蔽状态，顺便删除已经过期的记录。
+        """
+        async with self.lock:
+            async with aiosqlite.connect(SHARED_DB_PATH) as db:
+                await self.ensure_block_table_exists(db)
+                await db.execute("DELETE FROM blocks WHERE end_time <= ?", (now,))
+                await db.commit()
+                cursor = await db.execute("SELECT user_id, end_time FROM blocks")
+                rows = await cursor.fetchall()
+                return {row[0]: row[1] for row in rows}
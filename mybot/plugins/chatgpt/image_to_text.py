@@ -2,14 +2,18 @@ import nonebot
 import aiohttp
 import asyncio
 import os
+import re
 import time
 import ssl
 from datetime import datetime
-from loguru import logger
 from .config import config
+from .log import get_logger
+
+logger = get_logger("image")
 
 # 缓存图片的目录
 IMAGE_CACHE_DIR = "image_cache"
+IMAGE_TO_TEXT_FAILED = "[image 转文字失败]"
 
 # 创建缓存目录，如果不存在
 if not os.path.exists(IMAGE_CACHE_DIR):
@@ -74,7 +78,7 @@ async def image_to_text(image_url: str) -> str:
     # 下载图片到本地
     image_path = await download_image(image_url)
     if not image_path:
-        return "[image 转文字失败]"
+        return IMAGE_TO_TEXT_FAILED
 
     url = f"https://api.cloudflare.com/client/v4/accounts/{config.cloudflare_account_id}/ai/run/@cf/llava-hf/llava-1.5-7b-hf"
     headers = {
@@ -94,25 +98,63 @@ async def image_to_text(image_url: str) -> str:
                 "max_tokens": 512
             }
 
-            logger.debug(f"Sending request to {url} with headers: {headers}")
+            logger.debug("Sending request to {} with headers: {}", url, headers)
             async with session.post(url, headers=headers, json=inputs) as response:
                 result = await response.json()
-                logger.debug(f"Received response: {result}")
+                logger.debug("Received response: {}", result)
                 if response.status == 200 and result.get("success"):
-                    description = result["result"].get("description", "[image 转文字失败]")
-                    logger.info(f"Image to text conversion successful: {description}")
+                    description = result["result"].get("description", IMAGE_TO_TEXT_FAILED)
+                    logger.info("Image to text conversion successful: {}", description)
                     return description
                 else:
                     error_message = result.get('errors', [{'message': '未知错误'}])[0]['message']
                     logger.error(f"请求失败: {error_message}")
-                    return "[image 转文字失败]"
+                    return IMAGE_TO_TEXT_FAILED
         except aiohttp.ClientError as e:
             logger.error(f"HTTP请求出错: {e}")
-            return "[image 转文字失败]"
+            return IMAGE_TO_TEXT_FAILED
         except Exception as e:
             logger.error(f"请求出错: {e}")
-            return "[image 转文字失败]"
+            return IMAGE_TO_TEXT_FAILED
+
+
+
+# 延迟识图时消息内容里只留一个不含链接的占位符，图片的file id和链接另存在 pending_images 表里，
+# 只有真正的图片段才会写进去，用户自己打出来的占位符文字不会被当成图片去下载
+# 下面的正则也匹配旧版本存下的带链接的占位符，它们只用于显示成识别失败，不会再被下载
+IMAGE_PLACEHOLDER_PATTERN = re.compile(r"\[图片待识别[#:][^\]]*\]")
+
+def image_placeholder(index: int) -> str:
+    return f"[图片待识别#{index}]"
 
+def strip_image_placeholders(text: str) -> str:
+    # 用户发的文字里不允许出现占位符格式
+    return IMAGE_PLACEHOLDER_PATTERN.sub("", text)
+
+async def describe_images(bot, images: list) -> dict:
+    """
+    批量识别图片，同时进行的请求数由 oachat_image_concurrency 限制。
+
+    :param bot: 用于重新获取过期图片链接的Bot
+    :param images: 需要识别的 (键, file id, 图片URL) 列表
+    :return: 键到描述内容的映射，识别失败的为 IMAGE_TO_TEXT_FAILED
+    """
+    semaphore = asyncio.Semaphore(config.oachat_image_concurrency)
+
+    async def describe(file_id: str, image_url: str) -> str:
+        async with semaphore:
+            description = await image_to_text(image_url)
+            if description != IMAGE_TO_TEXT_FAILED or not file_id:
+                return description
+            try:
+                fresh_url = (await bot.get_image(file=file_id)).get("url")
+            except Exception as e:
+                logger.error(f"重新获取图片链接失败: {e}")
+                return description
+            return await image_to_text(fresh_url) if fresh_url else description
+
+    descriptions = await asyncio.gather(*(describe(file_id, image_url) for _, file_id, image_url in images))
+    return {key: description for (key, _, _), description in zip(images, descriptions)}
 
 
 @nonebot.get_driver().on_startup
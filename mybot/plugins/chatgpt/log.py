@@ -0,0 +1,80 @@
+import random
+import re
+from loguru import logger
+from nonebot import get_driver
+from .config import config
+
+# 这里是插件自己的日志封装，按子系统分别设置级别和采样率，可以用 /日志 指令在运行时调整。
+# 参数只有在这条日志真的要输出时才会格式化，传入函数的话会在那时才调用，避免热路径上白白拼接大段上下文。
+
+def level_no(level) -> int:
+    return level if isinstance(level, int) else logger.level(level.upper()).no
+
+SUBSYSTEMS = ["message", "chat", "queue", "image", "summary", "sender"]
+# 没有单独配置 OACHAT_LOG_LEVEL 时跟随 nonebot 的 LOG_LEVEL，低于这个级别的日志不会被格式化
+# bot.py 的控制台输出对插件日志只看这里的子系统级别，所以 /日志 可以把单个子系统调到比 LOG_LEVEL 更低
+subsystem_levels = {name: config.oachat_log_level or get_driver().config.log_level for name in SUBSYSTEMS}
+subsystem_sample_rates = {name: config.oachat_log_sample_rate for name in SUBSYSTEMS}
+
+BEARER_PATTERN = re.compile(r"Bearer\s+\S+")
+
+def redact(text: str) -> str:
+    for secret in (config.openai_api_key, config.cloudflare_api_key):
+        if secret:
+            text = text.replace(secret, "***")
+    return BEARER_PATTERN.sub("Bearer ***", text)
+
+def truncate(value) -> str:
+    text = str(value)
+    limit = config.oachat_log_max_length
+    if len(text) <= limit:
+        return redact(text)
+    # 先截断再脱敏，不扫描整段大内容；多留一个密钥长度的余量，保证跨过截断点的密钥也能被完整替换
+    margin = max(len(config.openai_api_key), len(config.cloudflare_api_key))
+    return f"{redact(text[:limit + margin])[:limit]}...(共{len(text)}字)"
+
+class PluginLogger:
+    def __init__(self, subsystem: str):
+        self.subsystem = subsystem
+        self.logger = logger.bind(subsystem=subsystem)
+
+    def enabled(self, level: str) -> bool:
+        return logger.level(level).no >= level_no(subsystem_levels[self.subsystem])
+
+    def log(self, level: str, message: str, *args):
+        if not self.enabled(level):
+            return
+        # 只对 DEBUG/INFO 采样，警告和错误总是输出
+        if logger.level(level).no < logger.level("WARNING").no and random.random() >= subsystem_sample_rates[self.subsystem]:
+            return
+        if args:
+            message = message.format(*(truncate(arg() if callable(arg) else arg) for arg in args))
+        self.logger.opt(depth=2).log(level, "{}", redact(message))
+
+    def debug(self, message: str, *args):
+        self.log("DEBUG", message, *args)
+
+    def info(self, message: str, *args):
+        self.log("INFO", message, *args)
+
+    def warning(self, message: str, *args):
+        self.log("WARNING", message, *args)
+
+    def error(self, message: str, *args):
+        self.log("ERROR", message, *args)
+
+def get_logger(subsystem: str) -> PluginLogger:
+    return PluginLogger(subsystem)
+
+def set_subsystem_level(subsystem: str, level: str, sample_rate: float = None):
+    """
+    运行时调整某个子系统的日志级别和采样率，子系统名、级别或采样率不合法时抛出 ValueError。
+    """
+    if subsystem not in subsystem_levels:
+        raise ValueError(f"未知的子系统: {subsystem}")
+    logger.level(level)  # 级别不存在时 loguru 会抛出 ValueError
+    if sample_rate is not None and not 0 <= sample_rate <= 1:
+        raise ValueError(f"采样率需要在0到1之间: {sample_rate}")
+    subsystem_levels[subsystem] = level
+    if sample_rate is not None:
+        subsystem_sample_rates[subsystem] = sample_rate
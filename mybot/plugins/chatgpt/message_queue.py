@@ -1,9 +1,12 @@
 import asyncio
-from loguru import logger
 from .database import Database
 from .config import config
+from .log import get_logger
+from .image_to_text import IMAGE_PLACEHOLDER_PATTERN, IMAGE_TO_TEXT_FAILED, describe_images
 from datetime import datetime
 
+logger = get_logger("queue")
+
 class MessageQueue:
     def __init__(self, id: str, db: Database, is_group: bool = True):
         self.id = id
@@ -12,13 +15,20 @@ class MessageQueue:
         self.max_size = config.oachat_queue_size_group if is_group else config.oachat_queue_size_private
         self.buffer = []
         self.lock = asyncio.Lock()
+        self.summary = ""  # 较早聊天记录的滚动摘要，由后台压缩任务维护
+        self.summary_last_id = 0  # 摘要覆盖到的最后一条消息id，之后的消息才以原文发送
+        self.failed_images = set()  # 本次运行中识别失败的图片记录id，避免每次触发都重复识别
 
     async def load_history(self):
         messages = await self.db.get_messages(self.id, self.max_size, self.is_group)
         self.buffer.extend(messages)
+        summary = await self.db.get_latest_summary(self.id, self.is_group)
+        if summary:
+            self.summary = summary["content"]
+            self.summary_last_id = summary["last_message_id"]
         logger.info(f"Loaded {len(messages)} messages for {'group' if self.is_group else 'private chat'} {self.id}")
 
-    async def add_message(self, message: dict, time: int):
+    async def add_message(self, message: dict, time: int, images: list = None):
         async with self.lock:
             message_data = {
                 "timestamp": time,
@@ -30,14 +40,60 @@ class MessageQueue:
                 "user_name": message.get("user_name", ""),
                 "content": message.get("content", "")
             }
-            await self.db.add_message(self.id, message_data, time, self.is_group)
+            message_data["id"] = await self.db.add_message(self.id, message_data, time, self.is_group, images)
             self.buffer.append(message_data)
             if len(self.buffer) > self.max_size:
                 self.buffer.pop(0)
-            logger.debug(f"Message added to queue: {message_data}")
+            logger.debug("Message added to queue: {}", message_data)
+
+    async def get_history_window(self) -> list:
+        """
+        返回要以原文发给AI的消息：有摘要时是摘要之后的所有消息，队列接不上摘要时从数据库补齐。
+        """
+        if not self.summary_last_id:
+            return list(self.buffer)
+        if self.buffer and self.buffer[0].get("id", 0) <= self.summary_last_id + 1:
+            return [msg for msg in self.buffer if msg.get("id", 0) > self.summary_last_id]
+        # 摘要压缩还没追上，摘要和队列之间的消息也要发给AI，不然中间会断一截
+        limit = self.max_size + config.oachat_summary_keep_recent + config.oachat_summary_batch
+        rows = await self.db.get_messages_after(self.id, self.summary_last_id, limit, self.is_group)
+        buffered = {msg.get("id"): msg for msg in self.buffer}
+        return [buffered.get(row["id"], row) for row in rows]
+
+    def get_messages(self, window: list) -> list:
+        # 没识别出来的图片不把链接发给AI
+        return [IMAGE_PLACEHOLDER_PATTERN.sub(IMAGE_TO_TEXT_FAILED, self.format_message(msg)) for msg in window]
+
+    async def resolve_images(self, bot, window: list):
+        """
+        识别即将发送给AI的消息中还没识别的图片，并把描述写回数据库。
+        识别失败的图片保留占位符，本次运行期间不再重复尝试。
+        """
+        messages = {msg["id"]: msg for msg in window if msg.get("id") and IMAGE_PLACEHOLDER_PATTERN.search(msg["content"])}
+        if not messages:
+            return
+        pending = [image for image in await self.db.get_pending_images(self.id, list(messages), self.is_group) if image["id"] not in self.failed_images]
+        if not pending:
+            return
+        descriptions = await describe_images(bot, [(image["id"], image["file_id"], image["url"]) for image in pending])
+        contents = {}
+        resolved = []
+        for image in pending:
+            description = descriptions[image["id"]]
+            if description == IMAGE_TO_TEXT_FAILED:
+                self.failed_images.add(image["id"])
+                continue
+            msg = messages[image["message_id"]]
+            msg["content"] = msg["content"].replace(image["placeholder"], description, 1)
+            contents[msg["id"]] = msg["content"]
+            resolved.append(image["id"])
+        if resolved:
+            await self.db.resolve_pending_images(self.id, contents, resolved, self.is_group)
+        logger.info(f"已为 {self.id} 识别 {len(resolved)} 张延迟识图的图片，失败 {len(pending) - len(resolved)} 张")
 
-    def get_messages(self):
-        return [self.format_message(msg) for msg in self.buffer]
+    def set_summary(self, content: str, last_message_id: int):
+        self.summary = content
+        self.summary_last_id = last_message_id
 
     def format_message(self, message: dict) -> str:
         formatted_time = datetime.fromtimestamp(message['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
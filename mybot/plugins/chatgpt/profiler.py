@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from .config import config
+from .log import get_logger
+
+logger = get_logger("chat")
+
+PROFILE_DIR = "profiles"
+
+# 这里是给 bot 主人用的在线性能分析，一个后台线程定时抓取事件循环所在线程的调用栈，
+# 同时临时打开 asyncio 的调试模式，记录阻塞事件循环超过阈值的回调，
+# 结果写成 flamegraph.pl / speedscope 能直接读的折叠栈文件，并生成一段简短的汇总发回聊天
+
+profile_running = False
+
+def is_idle(leaf: str) -> bool:
+    # 事件循环空闲时停在 selectors 模块里等待 IO，这些采样不算热点
+    return "(selectors.py:" in leaf
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SlowCallbackHandler(logging.Handler):
+    """
+    收集 asyncio 调试模式下输出的 "Executing ... took ... seconds" 慢回调警告。
+    """
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Executing"):
+            self.records.append(message)
+
+def sample_stacks(thread_id: int, interval: float, stop: threading.Event, stacks: Counter):
+    while not stop.is_set():
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(format_frame(frame))
+            frame = frame.f_back
+        if stack:
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+def write_collapsed(path: str, stacks: Counter):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+async def profile_event_loop(duration: float, slow_callback_ms: int) -> str:
+    """
+    对正在运行的事件循环采样 duration 秒，返回给聊天的汇总文本。
+    """
+    global profile_running
+    if profile_running:
+        return "已经有一个性能分析在进行中了。"
+    profile_running = True
+
+    loop = asyncio.get_running_loop()
+    old_debug = loop.get_debug()
+    old_slow_callback_duration = loop.slow_callback_duration
+    handler = SlowCallbackHandler()
+    asyncio_logger = logging.getLogger("asyncio")
+    stacks = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=sample_stacks,
+        args=(threading.get_ident(), config.oachat_profile_sample_interval, stop, stacks),
+        daemon=True,
+    )
+
+    asyncio_logger.addHandler(handler)
+    loop.slow_callback_duration = slow_callback_ms / 1000
+    loop.set_debug(True)
+    sampler.start()
+    logger.info(f"开始性能分析，时长 {duration} 秒，慢回调阈值 {slow_callback_ms} 毫秒")
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+        loop.set_debug(old_debug)
+        loop.slow_callback_duration = old_slow_callback_duration
+        asyncio_logger.removeHandler(handler)
+        profile_running = False
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_path = os.path.join(PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d%H%M%S')}.collapsed")
+    await asyncio.to_thread(write_collapsed, profile_path, stacks)
+
+    total = sum(stacks.values())
+    idle = 0
+    leaf_counts = Counter()
+    for stack, count in stacks.items():
+        leaf = stack.rsplit(";", 1)[-1]
+        if is_idle(leaf):
+            idle += count
+        else:
+            leaf_counts[leaf] += count
+
+    lines = [f"性能分析完成，共采样 {total} 次，折叠栈文件：{profile_path}"]
+    if total:
+        lines.append(f"{idle * 100 / total:.1f}% 空闲（等待IO）")
+    for leaf, count in leaf_counts.most_common(config.oachat_profile_top_n):
+        lines.append(f"{count * 100 / total:.1f}% {leaf}")
+    lines.append(f"阻塞事件循环超过 {slow_callback_ms} 毫秒的回调：{len(handler.records)} 次")
+    for record in handler.records[:3]:
+        lines.append(record[:200])
+    logger.info(f"性能分析完成，结果已写入 {profile_path}")
+    return "\n".join(lines)
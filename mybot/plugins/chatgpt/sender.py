@@ -0,0 +1,67 @@
+import asyncio
+import random
+import time
+from collections import deque
+from .config import config
+from .log import get_logger
+
+logger = get_logger("sender")
+
+# 这里是发送消息的调度器，handle_chat 把分好段的回复整个交过来就可以返回了，
+# 模拟打字的随机延迟由每个会话自己的发送任务来等，不再占着对话的锁和冷却状态
+
+class SendScheduler:
+    def __init__(self, min_delay: int, max_delay: int):
+        if config.oachat_send_rate <= 0:
+            raise ValueError(f"oachat_send_rate 必须大于0，当前为 {config.oachat_send_rate}")
+        self.interval = 1 / config.oachat_send_rate  # 两次调用发送接口之间的最小间隔，单位秒
+        self.min_delay = min_delay
+        self.max_delay = max_delay  # 单位是毫秒，和 __init__ 里的 MIN_DELAY / MAX_DELAY 一致
+        self.queues = {}  # 每个会话待发送的消息段
+        self.workers = {}  # 每个会话正在运行的发送任务
+        self.rate_lock = asyncio.Lock()
+        self.last_send = 0.0
+
+    def submit(self, bot, event, chat_id, segments: list):
+        """
+        把一条回复的所有消息段加入该会话的发送队列，立即返回。
+        """
+        queue = self.queues.setdefault(chat_id, deque())
+        for segment in segments:
+            queue.append((bot, event, segment))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.run_chat(chat_id))
+
+    async def run_chat(self, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                bot, event, segment = queue.popleft()
+                await self.send_with_retry(bot, event, chat_id, segment)
+                # 随机延迟
+                delay = random.randint(self.min_delay, self.max_delay) / 1000.0
+                await asyncio.sleep(delay)
+        finally:
+            # 队列为空时发送任务结束，下次有新回复时再创建
+            del self.workers[chat_id]
+
+    async def wait_rate_limit(self):
+        # 所有会话共用的限速，两次调用 OneBot 发送接口之间至少间隔 1 / oachat_send_rate 秒
+        async with self.rate_lock:
+            wait = self.last_send + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.last_send = time.monotonic()
+
+    async def send_with_retry(self, bot, event, chat_id, segment):
+        for attempt in range(config.oachat_send_retries + 1):
+            await self.wait_rate_limit()
+            try:
+                await bot.send(event, segment)
+                return
+            except Exception as e:
+                logger.error(f"会话 {chat_id} 消息发送失败(第 {attempt + 1} 次): {e}")
+                if attempt < config.oachat_send_retries:
+                    await asyncio.sleep(attempt + 1)
+        # 这段回复已经作为已发送记进了聊天记录，这里记下会话号方便对照
+        logger.error("会话 {} 消息发送重试次数用尽，已放弃（聊天记录中仍保留这段回复）: {}", chat_id, segment)
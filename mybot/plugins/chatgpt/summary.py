@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime
+from .config import config
+from .log import get_logger
+from .api import call_openai_api
+from .message_queue import MessageQueue
+from .image_to_text import IMAGE_PLACEHOLDER_PATTERN
+
+logger = get_logger("summary")
+
+# 这里是后台的聊天记录摘要压缩，把较早的消息交给AI浓缩成一段摘要存进数据库，
+# 构建提示词时就只需要发送 摘要 + 最近的原文消息，不用再塞几百行历史记录
+
+SUMMARY_PROMPT = (
+    "下面是一段QQ聊天记录，请用简洁的中文把它浓缩成一段摘要，保留参与者的名字和QQ号、讨论的话题、重要的事实和约定，"
+    "不要编造内容，不要输出摘要以外的东西。\n"
+)
+
+async def summarize_queue(queue: MessageQueue) -> bool | None:
+    """
+    对一个会话做一次摘要压缩。未摘要的旧消息不足一批时返回 None，否则请求AI并返回是否成功。
+    """
+    after_id = queue.summary_last_id
+    if not queue.summary:
+        # 第一次压缩从原文窗口前面一批开始，不去翻很久以前的历史，摘要和原文窗口才能接得上
+        after_id = await queue.db.get_message_id_before_latest(
+            queue.id, config.oachat_summary_keep_recent + config.oachat_summary_batch, queue.is_group
+        )
+    rows = await queue.db.get_unsummarized_messages(
+        queue.id, after_id, config.oachat_summary_keep_recent, config.oachat_summary_batch, queue.is_group
+    )
+    if len(rows) < config.oachat_summary_batch:
+        return None
+
+    context = SUMMARY_PROMPT
+    if queue.summary:
+        context += f"----------\n之前的摘要：\n{queue.summary}\n"
+    # 摘要里用不到还没识别的图片，不为它们额外调用识图
+    context += "----------\n新的聊天记录：\n" + "\n".join(IMAGE_PLACEHOLDER_PATTERN.sub("[图片]", queue.format_message(row)) for row in rows)
+
+    summary = await call_openai_api(context, config.oachat_summary_max_tokens)
+    if not summary or summary in ("请求失败", "请求出错"):
+        logger.error(f"会话 {queue.id} 摘要压缩失败，下次巡检再试")
+        return False
+
+    last_message_id = rows[-1]["id"]
+    await queue.db.add_summary(queue.id, last_message_id, summary, int(datetime.now().timestamp()), queue.is_group)
+    queue.set_summary(summary, last_message_id)
+    logger.info(f"会话 {queue.id} 已压缩 {len(rows)} 条消息为摘要，覆盖至消息id {last_message_id}")
+    return True
+
+async def compact_history(group_queues: dict):
+    """
+    定期巡检所有已加载的会话，每个会话连续压缩直到追上原文窗口，每次AI请求之间至少间隔 oachat_summary_min_gap 秒。
+    """
+    while True:
+        await asyncio.sleep(config.oachat_summary_interval)
+        for chat_id, queue in list(group_queues.items()):
+            while True:
+                try:
+                    success = await summarize_queue(queue)
+                except Exception as e:
+                    logger.error(f"会话 {chat_id} 摘要压缩出错: {e}")
+                    break
+                if success is None:
+                    break
+                await asyncio.sleep(config.oachat_summary_min_gap)
+                if not success:
+                    break
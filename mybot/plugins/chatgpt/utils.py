@@ -1,3 +1,6 @@
+import zlib
+from .config import config
+
 def build_openai_request(context: str, max_tokens: int, model: str = "DD"):  ## 使用不同的模型，DD可以改为需要调用的模型，比如gpt-4
     return {
         "model": model,
@@ -6,3 +9,10 @@ def build_openai_request(context: str, max_tokens: int, model: str = "DD"):  ##
         "temperature": 0.7  # 温度参数，可以调整
     }
 
+def owns_chat(chat_id) -> bool:
+    """
+    判断会话是否由当前分片进程负责，规则必须和 shard_router.py 的 pick_worker 一致。
+    """
+    if config.oachat_shard_count <= 1:
+        return True
+    return zlib.crc32(str(chat_id).encode()) % config.oachat_shard_count == config.oachat_shard_index
@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import json
+import time
+import zlib
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+#  这是分片运行时的前置路由进程，LLOnebot 的反向ws连到这里，再按 chat_id 的哈希把事件转发给多个 bot.py 进程
+#  每个 bot.py 进程用不同的端口启动，例如 PORT=8081 python bot.py，.env 里把 OACHAT_SHARD_COUNT 设成进程数
+#  启动方式：python shard_router.py --listen 127.0.0.1:8080 --worker ws://127.0.0.1:8081/onebot/v11/ws --worker ws://127.0.0.1:8082/onebot/v11/ws
+
+FORWARD_HEADERS = ("X-Self-ID", "X-Client-Role", "Authorization", "User-Agent")
+PENDING_CALL_TIMEOUT = 60  # API 调用超过这么多秒还没收到返回就不再等，丢掉对应的 echo 记录
+
+
+def get_chat_key(event: dict) -> str | None:
+    """
+    和插件里的 chat_id 规则保持一致，群聊用群号，私聊用 private_用户号，没有会话归属的事件返回 None。
+    """
+    if event.get("group_id"):
+        return str(event["group_id"])
+    if event.get("user_id"):
+        return f"private_{event['user_id']}"
+    return None
+
+
+def pick_worker(chat_key: str, worker_count: int) -> int:
+    # 不能用内置的 hash()，它每次启动的结果都不一样，重启后同一个群会被分到别的进程
+    return zlib.crc32(chat_key.encode()) % worker_count
+
+
+class ShardRouter:
+    def __init__(self, worker_urls: list[str]):
+        self.worker_urls = worker_urls
+        self.echo_seq = 0
+
+    async def handle_upstream(self, request: web.Request) -> web.WebSocketResponse:
+        upstream = web.WebSocketResponse()
+        await upstream.prepare(request)
+        headers = {key: request.headers[key] for key in FORWARD_HEADERS if key in request.headers}
+        logger.info(f"OneBot 已连接: {headers.get('X-Self-ID')}")
+
+        pending_calls = {}  # 改写后的 echo -> (worker 下标, 原始 echo, 发出时间)
+
+        async with aiohttp.ClientSession() as session:
+            try:
+                workers = [await session.ws_connect(url, headers=headers) for url in self.worker_urls]
+            except aiohttp.ClientError as e:
+                logger.error(f"连接分片进程失败: {e}")
+                await upstream.close()
+                return upstream
+
+            async def forward_from_worker(index: int, worker: aiohttp.ClientWebSocketResponse):
+                # 分片进程发来的是 API 调用，echo 需要改写成全局唯一的，不然各进程的序号会撞在一起
+                try:
+                    async for msg in worker:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+                        data = json.loads(msg.data)
+                        if "echo" in data:
+                            now = time.monotonic()
+                            for echo in [e for e, call in pending_calls.items() if now - call[2] > PENDING_CALL_TIMEOUT]:
+                                del pending_calls[echo]
+                            self.echo_seq += 1
+                            pending_calls[self.echo_seq] = (index, data["echo"], now)
+                            data["echo"] = self.echo_seq
+                        await upstream.send_str(json.dumps(data, ensure_ascii=False))
+                    logger.warning(f"分片进程 {index} 已断开，关闭上游连接等待 OneBot 重连")
+                    await upstream.close()
+                finally:
+                    # 这个进程已经收不到返回了，它的 echo 记录也不用留着
+                    for echo in [e for e, call in pending_calls.items() if call[0] == index]:
+                        del pending_calls[echo]
+
+            tasks = [asyncio.create_task(forward_from_worker(i, w)) for i, w in enumerate(workers)]
+            try:
+                async for msg in upstream:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    data = json.loads(msg.data)
+
+                    # API 调用的返回结果，按 echo 送回发起调用的进程
+                    if "post_type" not in data and data.get("echo") in pending_calls:
+                        index, echo, _ = pending_calls.pop(data["echo"])
+                        data["echo"] = echo
+                        await workers[index].send_str(json.dumps(data, ensure_ascii=False))
+                        continue
+
+                    chat_key = get_chat_key(data)
+                    if chat_key is None or data.get("post_type") == "meta_event":
+                        # 心跳和生命周期之类的事件每个进程都要收到
+                        for worker in workers:
+                            await worker.send_str(msg.data)
+                    else:
+                        await workers[pick_worker(chat_key, len(workers))].send_str(msg.data)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                for worker in workers:
+                    await worker.close()
+                logger.info("OneBot 连接已关闭")
+        return upstream
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按会话哈希把 OneBot 事件分发给多个 bot 进程")
+    parser.add_argument("--listen", default="127.0.0.1:8080", help="监听地址，LLOnebot 的反向ws填这里")
+    parser.add_argument("--path", default="/onebot/v11/ws", help="反向ws的路径")
+    parser.add_argument("--worker", action="append", required=True, help="分片进程的反向ws地址，可以写多个")
+    args = parser.parse_args()
+
+    host, port = args.listen.rsplit(":", 1)
+    router = ShardRouter(args.worker)
+    app = web.Application()
+    app.router.add_get(args.path, router.handle_upstream)
+    logger.info(f"分片路由启动，共 {len(args.worker)} 个分片进程")
+    web.run_app(app, host=host, port=int(port))
+
+
+if __name__ == "__main__":
+    main()